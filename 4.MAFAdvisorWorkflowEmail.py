@@ -2,30 +2,67 @@
 # SABADELL ADVISOR WORKFLOW: Product Advisory + Compliance Control
 # ============================================================================
 # Flujo: Cliente pregunta → Need Profiler → Sabadell Copilot Expert →
-#        Clarity Writer → Compliance Checker → [Approved → Publisher | Rejected → Loop]
+#        [Clarity Writer ∥ Compliance Pre-Scan] → Compliance Checker →
+#        [Approved → Publisher | Rejected → Loop]
+#        (el Publisher arranca especulativamente en paralelo con Compliance)
 # ============================================================================
 import os
+import re
+import time
 import asyncio
+import functools
 import logging
-from typing import Any
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Awaitable, Callable, Final, TypeVar
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 from agent_framework import (
     WorkflowBuilder,
     AgentExecutor,
     AgentExecutorRequest,
     AgentExecutorResponse,
+    AgentProtocol,
+    AgentRunEvent,
+    AgentRunResponse,
+    AgentRunResponseUpdate,
+    AgentRunUpdateEvent,
+    ChatAgent,
     ChatMessage,
+    Executor,
     Role,
     WorkflowContext,
     executor,
+    handler,
 )
 from agent_framework.azure import AzureAIAgentClient
 from agent_framework.microsoft import CopilotStudioAgent
+from azure.ai.projects.aio import AIProjectClient
 from azure.identity import DefaultAzureCredential
+from msal_extensions import FilePersistence, PersistedTokenCache
 from pydantic import BaseModel
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Shared-state keys for the speculative compliance pre-scan barrier
+PRESCAN_PENDING_KEY = "compliance_prescan_pending"
+PRESCAN_RESULT_KEY = "compliance_prescan_result"
+PENDING_DRAFT_KEY = "compliance_pending_draft"
+
+# Header of the pre-scan findings note appended after the first Clarity draft
+PRESCAN_NOTE_HEADER = "PRE-CHEQUEO SOBRE LA INFORMACIÓN ORIGINAL:"
+
+# Shared-state key for the speculative Publisher task
+SPECULATIVE_PUBLISH_KEY = "speculative_publish_task"
+
+# Shared-state key for the Clarity Writer's service-side thread id
+CLARITY_THREAD_KEY = "clarity_writer_thread_id"
+
 
 # ============================================================================
 # STRUCTURED OUTPUT MODELS
@@ -62,86 +99,515 @@ class FinalResponse(BaseModel):
 
 
 # ============================================================================
-# CONDITIONAL ROUTING FUNCTIONS
+# PARSED OUTPUT CACHE
 # ============================================================================
 
-def approved_condition(message: Any) -> bool:
-    """Route to publisher only if compliance approved."""
-    if not isinstance(message, AgentExecutorResponse):
-        return True
-    
-    try:
-        review = ComplianceReview.model_validate_json(message.agent_run_response.text)
-        return review.approved
-    except Exception:
-        return False
+ModelT = TypeVar("ModelT", bound=BaseModel)
 
+# Parsed structured outputs per agent response, keyed by the (hashable) AgentRunResponse.
+# Weak keys so entries go away together with the workflow messages.
+_parsed_cache: weakref.WeakKeyDictionary[Any, dict[type[BaseModel], BaseModel]] = weakref.WeakKeyDictionary()
 
-def rejected_condition(message: Any) -> bool:
-    """Route to clarity writer only if compliance rejected."""
-    if not isinstance(message, AgentExecutorResponse):
-        return True
-    
-    try:
-        review = ComplianceReview.model_validate_json(message.agent_run_response.text)
-        return not review.approved
-    except Exception:
-        return False
 
+# Their fields drive routing (approved, missing_info), so they are always fully validated
+_ROUTING_MODELS: Final = (ComplianceReview, NeedProfile)
 
-def missing_info_condition(message: Any) -> bool:
-    """Check if we need more info from user."""
-    if not isinstance(message, AgentExecutorResponse):
-        return False
-    
+
+def _fast_parse(model_cls: type[ModelT], text: str) -> ModelT:
+    """Parse trusted structured output without running validators.
+
+    Agents return JSON constrained by response_format, so when the payload has exactly the
+    model's fields it is built with model_construct; anything else goes through full validation.
+    Routing models are always validated: model_construct would keep e.g. approved="false" (truthy).
+    """
+    if issubclass(model_cls, _ROUTING_MODELS):
+        return model_cls.model_validate_json(text)
     try:
-        profile = NeedProfile.model_validate_json(message.agent_run_response.text)
-        return len(profile.missing_info) > 0
-    except Exception:
-        return False
+        data = orjson.loads(text)
+        if isinstance(data, dict) and data.keys() == model_cls.model_fields.keys():
+            return model_cls.model_construct(**data)
+    except orjson.JSONDecodeError:
+        pass
+    return model_cls.model_validate_json(text)
 
 
-def has_complete_info_condition(message: Any) -> bool:
-    """Check if we can proceed to Copilot Agent."""
-    if not isinstance(message, AgentExecutorResponse):
-        return False
-    
+def _get_parsed(message: AgentExecutorResponse, model_cls: type[ModelT]) -> ModelT:
+    """Parse an agent response into model_cls once and reuse the result across conditions and bridges.
+
+    Responses from agents with a response_format already carry the validated model in .value.
+    """
+    run_response = message.agent_run_response
+    if isinstance(run_response.value, model_cls):
+        return run_response.value
+    parsed = _parsed_cache.setdefault(run_response, {})
+    if model_cls not in parsed:
+        parsed[model_cls] = _fast_parse(model_cls, run_response.text)
+    return parsed[model_cls]  # type: ignore[return-value]
+
+
+def _get_review(message: AgentExecutorResponse) -> ComplianceReview:
+    """Cached ComplianceReview for a compliance agent response."""
+    return _get_parsed(message, ComplianceReview)
+
+
+def _get_profile(message: AgentExecutorResponse) -> NeedProfile:
+    """Cached NeedProfile for a need profiler response."""
+    return _get_parsed(message, NeedProfile)
+
+
+# ============================================================================
+# LLM CONCURRENCY LIMIT
+# ============================================================================
+
+# Máximo de llamadas simultáneas a los agentes (evita 429 del proveedor)
+_llm_sem = asyncio.Semaphore(int(os.getenv("MAF_MAX_CONCURRENCY", "8")))
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """True for throttling (429), timeouts (408), server errors (5xx) and dropped connections."""
+    current: BaseException | None = exc
+    while current is not None:
+        status = getattr(current, "status_code", None) or getattr(current, "status", None)
+        if isinstance(status, int) and (status in (408, 429) or status >= 500):
+            return True
+        if isinstance(current, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            return True
+        current = current.__cause__
+    return False
+
+
+def _retrying(retryable: Callable[[BaseException], bool] = _is_retryable) -> AsyncRetrying:
+    """Exponential backoff with jitter; the LLM slot is acquired per attempt, never held while sleeping."""
+    return AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_random_exponential(multiplier=0.5, max=8),
+        retry=retry_if_exception(retryable),
+        reraise=True,
+    )
+
+
+async def _run_agent(agent: AgentProtocol, messages: list[ChatMessage], **kwargs: Any) -> AgentRunResponse:
+    """Run an agent while holding a slot of the shared LLM concurrency limit, retrying transient errors.
+
+    Azure agents (ChatAgent) on a service-side thread go through _stream_agent and are only
+    retried before the service has accepted the run; retrying after that would post the
+    messages to the thread twice. AzureAIAgentClient streams internally for run() anyway.
+    Other agents (Copilot Studio, whose run_stream only yields typing activities) use run().
+    """
+    if isinstance(agent, ChatAgent) and kwargs.get("thread") is not None:
+        return await _stream_agent(
+            agent,
+            messages,
+            asyncio.Queue(),
+            output_format_type=agent.chat_options.response_format,
+            **kwargs,
+        )
+    async for attempt in _retrying():
+        with attempt:
+            async with _llm_sem:
+                return await agent.run(messages, **kwargs)
+    raise AssertionError("unreachable")  # AsyncRetrying re-raises the last error
+
+
+async def _stream_agent(
+    agent: AgentProtocol,
+    messages: list[ChatMessage],
+    updates: asyncio.Queue[AgentRunResponseUpdate | None],
+    *,
+    output_format_type: type[BaseModel] | None = None,
+    **kwargs: Any,
+) -> AgentRunResponse:
+    """Stream an agent run into `updates` (None marks the end) and return the joined response.
+
+    Only retried while nothing has been streamed yet: the first update (run created) means the
+    service accepted the run, so a retry could duplicate tokens or thread messages.
+    """
+    collected: list[AgentRunResponseUpdate] = []
     try:
-        profile = NeedProfile.model_validate_json(message.agent_run_response.text)
-        has_info = len(profile.missing_info) == 0
-        return has_info
-    except Exception as e:
-        # Si hay error parseando, asumimos que NO podemos continuar
-        print(f"Error parsing NeedProfile: {e}")
-        return False
+        async for attempt in _retrying(lambda exc: not collected and _is_retryable(exc)):
+            with attempt:
+                async with _llm_sem:
+                    async for update in agent.run_stream(messages, **kwargs):
+                        collected.append(update)
+                        updates.put_nowait(update)
+    finally:
+        updates.put_nowait(None)
+    return AgentRunResponse.from_agent_run_response_updates(collected, output_format_type=output_format_type)
+
+
+# Fused stage transformer: receives the agent response instead of it being sent downstream
+PostTransform = Callable[[AgentExecutorResponse, WorkflowContext[Any, Any]], Awaitable[None]]
+
+
+class ThrottledAgentExecutor(AgentExecutor):
+    """AgentExecutor whose agent calls are gated by the shared LLM concurrency limit.
+
+    If thread_state_key is given, the service-side thread id is published to shared state
+    after each run so bridges can send deltas instead of re-embedding the whole conversation.
+
+    If post_transform is given, the agent response is handed to it instead of being sent
+    downstream, so a bridge step runs inside this executor rather than as its own graph node.
+    post_output_types / post_workflow_output_types declare what the transform may send / yield.
+    """
+
+    def __init__(
+        self,
+        agent: AgentProtocol,
+        *,
+        id: str,
+        thread_state_key: str | None = None,
+        post_transform: PostTransform | None = None,
+        post_output_types: list[type[Any]] | None = None,
+        post_workflow_output_types: list[type[Any]] | None = None,
+    ):
+        super().__init__(agent, id=id)
+        self._thread_state_key = thread_state_key
+        self._post_transform = post_transform
+        self._post_output_types = post_output_types or []
+        self._post_workflow_output_types = post_workflow_output_types or []
+
+    @property
+    def output_types(self) -> list[type[Any]]:
+        return [*super().output_types, *self._post_output_types]
+
+    @property
+    def workflow_output_types(self) -> list[type[Any]]:
+        return [*super().workflow_output_types, *self._post_workflow_output_types]
+
+    async def _invoke_agent(self, ctx: WorkflowContext[Any, Any]) -> tuple[AgentRunResponse, bool]:
+        """Run the agent under the concurrency limit; returns (response, streamed)."""
+        if not ctx.is_streaming():
+            return await _run_agent(self._agent, self._cache, thread=self._agent_thread), False
+        
+        # Reenviamos los tokens a DevUI a medida que llegan
+        response_format = self._agent.chat_options.response_format if isinstance(self._agent, ChatAgent) else None
+        updates: asyncio.Queue[AgentRunResponseUpdate | None] = asyncio.Queue()
+        task = asyncio.create_task(_stream_agent(
+            self._agent,
+            self._cache,
+            updates,
+            output_format_type=response_format,
+            thread=self._agent_thread,
+        ))
+        while (update := await updates.get()) is not None:
+            await ctx.add_event(AgentRunUpdateEvent(self.id, update))
+        return await task, True
+
+    async def _run_agent_and_emit(self, ctx: WorkflowContext[AgentExecutorResponse, AgentRunResponse]) -> None:
+        response, streamed = await self._invoke_agent(ctx)
+        await self._emit_response(ctx, response, emit_event=not streamed)
+
+    async def _emit_response(
+        self,
+        ctx: WorkflowContext[AgentExecutorResponse, AgentRunResponse],
+        response: AgentRunResponse,
+        *,
+        emit_event: bool = True,
+    ) -> None:
+        """Send a response downstream (or through post_transform) like AgentExecutor does after a run."""
+        if emit_event:
+            await ctx.add_event(AgentRunEvent(self.id, response))
+        full_conversation = list(self._cache) + list(response.messages)
+        self._cache.clear()
+        
+        if self._thread_state_key and self._agent_thread.service_thread_id:
+            await ctx.set_shared_state(self._thread_state_key, self._agent_thread.service_thread_id)
+        
+        agent_response = AgentExecutorResponse(self.id, response, full_conversation=full_conversation)
+        if self._post_transform is None:
+            await ctx.send_message(agent_response)
+        else:
+            await self._post_transform(agent_response, ctx)
 
 
 # ============================================================================
-# BRIDGE EXECUTORS (Transformers between stages)
+# LFU RESPONSE CACHE (Compliance + Need Profiler)
+# ============================================================================
+
+class LFUCache:
+    """Least-frequently-used cache; ties are broken by evicting the least recently used key."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._values: dict[str, tuple[str, int]] = {}
+        self._buckets: dict[int, OrderedDict[str, None]] = {}
+        self._min_freq = 0
+
+    def _touch(self, key: str) -> str:
+        value, freq = self._values[key]
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if self._min_freq == freq:
+                self._min_freq = freq + 1
+        self._values[key] = (value, freq + 1)
+        self._buckets.setdefault(freq + 1, OrderedDict())[key] = None
+        return value
+
+    def get(self, key: str) -> str | None:
+        if key not in self._values:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._touch(key)
+
+    def put(self, key: str, value: str) -> None:
+        if self.capacity <= 0:
+            return
+        if key in self._values:
+            self._touch(key)
+            self._values[key] = (value, self._values[key][1])
+            return
+        if len(self._values) >= self.capacity:
+            evicted, _ = self._buckets[self._min_freq].popitem(last=False)
+            if not self._buckets[self._min_freq]:
+                del self._buckets[self._min_freq]
+            del self._values[evicted]
+        self._values[key] = (value, 1)
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_freq = 1
+
+
+# Process-wide caches, shared by every workflow built in this process
+_need_profile_cache = LFUCache(capacity=50_000)
+_compliance_cache = LFUCache(capacity=50_000)
+
+
+def _normalize_prompt(messages: list[ChatMessage]) -> str:
+    """Cache key for a conversation: message texts with whitespace collapsed."""
+    return "\n".join(" ".join(message.text.split()) for message in messages)
+
+
+class CachedAgentExecutor(ThrottledAgentExecutor):
+    """AgentExecutor that serves repeated (normalized) prompts from an LFU cache.
+
+    Only responses that parsed into the agent's response_format are cached.
+    """
+
+    def __init__(self, agent: AgentProtocol, *, cache: LFUCache, id: str, **kwargs: Any):
+        super().__init__(agent, id=id, **kwargs)
+        self._response_cache = cache
+
+    async def _run_agent_and_emit(self, ctx: WorkflowContext[AgentExecutorResponse, AgentRunResponse]) -> None:
+        key = _normalize_prompt(self._cache)
+        cached = self._response_cache.get(key)
+        streamed = False
+        if cached is None:
+            response, streamed = await self._invoke_agent(ctx)
+            # Solo se cachean respuestas que cumplen el response_format (no vacías, truncadas o filtradas)
+            if response.value is not None:
+                self._response_cache.put(key, response.text)
+        else:
+            response = AgentRunResponse(messages=[ChatMessage(Role.ASSISTANT, text=cached)])
+        
+        stats = self._response_cache
+        logger.info(
+            f"💾 {self.id} cache {'hit' if cached is not None else 'miss'} "
+            f"(hits={stats.hits}, misses={stats.misses})"
+        )
+        
+        await self._emit_response(ctx, response, emit_event=not streamed)
+
+
+# ============================================================================
+# DETERMINISTIC COMPLIANCE PRE-GATE
+# ============================================================================
+
+# Todos deben aparecer para aprobar sin LLM: disclaimer + referencia a la web oficial
+_COMPLIANCE_REQUIRED_PATTERNS = [
+    re.compile(r"no\s+constituye\s+asesoramiento", re.IGNORECASE),
+    re.compile(r"bancsabadell\.com", re.IGNORECASE),
+]
+
+# Lenguaje prescriptivo / recomendación personalizada (tuteo y usted)
+_COMPLIANCE_FORBIDDEN_PATTERN = re.compile(
+    r"\b("
+    r"deber[ií]a[sn]?"
+    r"|deb(e|es|[eé]is|en)"
+    r"|tienes\s+que"
+    r"|recomendable"
+    r"|(te|le|les)\s+sugerimos"
+    r"|ideal\s+para"
+    r"|(le|les|te)\s+conviene[n]?"
+    r"|recomend(amos|ar[ií]amos)"
+    r"|recomiendo"
+    r"|aconsej(o|amos|ar[ií]amos)"
+    r"|mejor\s+opci[oó]n"
+    r"|lo\s+mejor\s+para\s+(ti|usted(es)?)"
+    r")\b",
+    re.IGNORECASE,
+)
+
+
+def passes_compliance_rules(content: str) -> bool:
+    """True if content has every mandatory mention and no prescriptive language.
+
+    >>> notice = " Esta información no constituye asesoramiento financiero. Más en bancsabadell.com."
+    >>> passes_compliance_rules("La Cuenta Online no tiene comisiones de mantenimiento." + notice)
+    True
+    >>> [passes_compliance_rules(text + notice) for text in (
+    ...     "Debes contratar la hipoteca.", "Tienes que abrir la cuenta.", "Es recomendable la tarjeta.",
+    ...     "Te sugerimos la Cuenta Online.", "Es ideal para ti.", "Le recomendamos contratar la cuenta.",
+    ...     "Usted debería pedirla.", "Le conviene esta tarjeta.", "Recomendamos la cuenta.",
+    ...     "Tu mejor opción es esta hipoteca.",
+    ... )]
+    [False, False, False, False, False, False, False, False, False, False]
+    """
+    return (
+        all(pattern.search(content) for pattern in _COMPLIANCE_REQUIRED_PATTERNS)
+        and _COMPLIANCE_FORBIDDEN_PATTERN.search(content) is None
+    )
+
+
+class RuleGatedComplianceExecutor(CachedAgentExecutor):
+    """Compliance executor that approves clearly compliant drafts without calling the LLM.
+
+    The rules are checked on the latest Clarity draft (the last ASSISTANT message). If a
+    pre-scan note follows that draft, the rules are skipped so the compliance agent can
+    review those findings. Drafts that miss a mandatory mention or contain prescriptive
+    wording also go to the compliance agent.
+    """
+
+    async def _run_agent_and_emit(self, ctx: WorkflowContext[AgentExecutorResponse, AgentRunResponse]) -> None:
+        draft_index = next(
+            (i for i in range(len(self._cache) - 1, -1, -1) if self._cache[i].role == Role.ASSISTANT),
+            None,
+        )
+        has_prescan_note = draft_index is not None and any(
+            message.text.startswith(PRESCAN_NOTE_HEADER) for message in self._cache[draft_index + 1:]
+        )
+        if draft_index is not None and not has_prescan_note:
+            draft = self._cache[draft_index]
+            try:
+                content = _fast_parse(ClarityExplanation, draft.text).full_content
+            except Exception:
+                content = draft.text
+            
+            if passes_compliance_rules(content):
+                logger.info(f"⚡ {self.id}: draft approved by deterministic rules (LLM skipped)")
+                review = ComplianceReview(approved=True, issues=[], feedback="", content=content)
+                response = AgentRunResponse(
+                    messages=[ChatMessage(Role.ASSISTANT, text=review.model_dump_json())],
+                    value=review,
+                )
+                await self._emit_response(ctx, response)
+                return
+        
+        await super()._run_agent_and_emit(ctx)
+
+
+# ============================================================================
+# CONDITIONAL ROUTING FUNCTIONS
+# ============================================================================
+
+def _make_condition(
+    model_cls: type[ModelT],
+    predicate: Callable[[ModelT], bool],
+    *,
+    passthrough: bool = False,
+) -> Callable[[Any], bool]:
+    """Build a routing condition over the cached parsed response.
+
+    Non-agent messages return `passthrough`; unparseable responses never match.
+    """
+    def condition(message: Any) -> bool:
+        if not isinstance(message, AgentExecutorResponse):
+            return passthrough
+        try:
+            return predicate(_get_parsed(message, model_cls))
+        except Exception as e:
+            # Si hay error parseando, asumimos que NO podemos continuar por esta rama
+            logger.warning(f"Error parsing {model_cls.__name__}: {e}")
+            return False
+    return condition
+
+
+# Route to publisher only if compliance approved
+approved_condition = _make_condition(ComplianceReview, lambda review: review.approved, passthrough=True)
+
+# Route to clarity writer only if compliance rejected
+rejected_condition = _make_condition(ComplianceReview, lambda review: not review.approved, passthrough=True)
+
+# Check if we can proceed to Copilot Agent (otherwise: ask the user for more info)
+has_complete_info_condition = _make_condition(NeedProfile, lambda profile: len(profile.missing_info) == 0)
+
+
+# ============================================================================
+# STAGE TRANSFORMERS (fused into the preceding agent via post_transform)
 # ============================================================================
 
-@executor(id="to_copilot_query")
 async def to_copilot_query(
     response: AgentExecutorResponse, 
     ctx: WorkflowContext[AgentExecutorRequest]
 ) -> None:
     """Convert need profile into Copilot Studio query."""
-    profile = NeedProfile.model_validate_json(response.agent_run_response.text)
+    profile = _get_profile(response)
     
     # Create structured query for Copilot Studio
     copilot_query = ChatMessage(
         Role.USER,
         text=profile.structured_query
     )
-    await ctx.send_message(AgentExecutorRequest(messages=[copilot_query], should_respond=True))
+    await ctx.send_message(
+        AgentExecutorRequest(messages=[copilot_query], should_respond=True),
+        target_id="sabadell_copilot_expert",
+    )
+
+
+async def request_more_info(
+    response: AgentExecutorResponse,
+    ctx: WorkflowContext[None, str]
+) -> None:
+    """Request missing information from user."""
+    try:
+        missing_info = _get_profile(response).missing_info
+    except Exception:
+        # Perfil ilegible: pedimos lo mínimo para poder continuar
+        missing_info = []
+    missing_info = missing_info or ["qué tipo de producto o servicio necesitas"]
+    
+    missing_items = "\n".join(f"- {item}" for item in missing_info)
+    output = (
+        f"📋 **Necesitamos más información para ayudarte mejor:**\n\n"
+        f"{missing_items}\n\n"
+        f"Por favor, proporciona estos datos para poder ofrecerte las mejores opciones del Banco Sabadell."
+    )
+    await ctx.yield_output(output)
+
+
+async def route_need_profile(
+    response: AgentExecutorResponse,
+    ctx: WorkflowContext[AgentExecutorRequest, str]
+) -> None:
+    """Need Profiler post-transform: complete profile → Copilot query, otherwise ask for more info."""
+    if has_complete_info_condition(response):
+        await to_copilot_query(response, ctx)
+    else:
+        await request_more_info(response, ctx)
+
+
+async def route_compliance_review(
+    response: AgentExecutorResponse,
+    ctx: WorkflowContext[AgentExecutorResponse | AgentExecutorRequest]
+) -> None:
+    """Compliance post-transform: approved → publish, rejected → revision request (loop)."""
+    if approved_condition(response):
+        await ctx.send_message(response, target_id="publish_final_response")
+    elif rejected_condition(response):
+        await to_clarity_revision(response, ctx)
+    else:
+        logger.warning("⚠️  Compliance review could not be parsed; dropping message")
+        await cancel_speculative_publish(ctx)
 
 
-@executor(id="to_clarity_request")
 async def to_clarity_request(
     response: AgentExecutorResponse,
     ctx: WorkflowContext[AgentExecutorRequest]
 ) -> None:
-    """Convert Copilot response into clarity writer request."""
+    """Fan out Copilot response to Clarity Writer and a speculative compliance pre-scan."""
     # El texto del Copilot Studio contiene la info de productos
     copilot_output = response.agent_run_response.text
     
@@ -149,229 +615,524 @@ async def to_clarity_request(
         Role.USER,
         text=f"Reescribe esta información de productos bancarios en lenguaje claro para el cliente:\n\n{copilot_output}"
     )
-    await ctx.send_message(AgentExecutorRequest(messages=[clarity_msg], should_respond=True))
+    prescan_msg = ChatMessage(
+        Role.USER,
+        text=f"Pre-chequeo de cumplimiento de la información original de productos:\n\n{copilot_output}"
+    )
+    
+    # El barrier retiene el borrador hasta que llegue el pre-scan (que nunca falla el run)
+    await ctx.set_shared_state(PRESCAN_PENDING_KEY, True)
+    await ctx.send_message(
+        AgentExecutorRequest(messages=[clarity_msg], should_respond=True),
+        target_id="clarity_writer",
+    )
+    await ctx.send_message(
+        AgentExecutorRequest(messages=[prescan_msg], should_respond=True),
+        target_id="compliance_prescan",
+    )
 
 
-@executor(id="to_clarity_revision")
 async def to_clarity_revision(
     response: AgentExecutorResponse,
     ctx: WorkflowContext[AgentExecutorRequest]
 ) -> None:
     """Convert compliance feedback into revision request."""
-    review = ComplianceReview.model_validate_json(response.agent_run_response.text)
+    # El borrador ha sido rechazado: descartamos la publicación especulativa
+    await cancel_speculative_publish(ctx)
     
-    # Create revision request with compliance feedback
-    revision_msg = ChatMessage(
-        Role.USER,
-        text=(
-            f"Por favor, revisa el contenido según este feedback de cumplimiento normativo:\n\n"
-            f"PROBLEMAS DETECTADOS:\n" + "\n".join(f"- {issue}" for issue in review.issues) + "\n\n"
-            f"FEEDBACK:\n{review.feedback}\n\n"
-            f"CONTENIDO ORIGINAL:\n{review.content}"
+    review = _get_review(response)
+    issues = "\n".join(f"- {issue}" for issue in review.issues)
+    
+    if await ctx.shared_state.has(CLARITY_THREAD_KEY):
+        # El thread del Clarity Writer ya contiene el borrador: solo enviamos el delta
+        revision_msg = ChatMessage(
+            Role.USER,
+            text=f"Revisa tu último borrador: {review.feedback}\nIssues:\n{issues}"
+        )
+    else:
+        # Create revision request with compliance feedback
+        revision_msg = ChatMessage(
+            Role.USER,
+            text=(
+                f"Por favor, revisa el contenido según este feedback de cumplimiento normativo:\n\n"
+                f"PROBLEMAS DETECTADOS:\n{issues}\n\n"
+                f"FEEDBACK:\n{review.feedback}\n\n"
+                f"CONTENIDO ORIGINAL:\n{review.content}"
+            )
         )
+    await ctx.send_message(
+        AgentExecutorRequest(messages=[revision_msg], should_respond=True),
+        target_id="clarity_writer",
     )
-    await ctx.send_message(AgentExecutorRequest(messages=[revision_msg], should_respond=True))
 
 
-@executor(id="request_more_info")
-async def request_more_info(
+# ============================================================================
+# BRIDGE EXECUTORS (Barrier + speculative Publisher)
+# ============================================================================
+
+class CompliancePrescanExecutor(ThrottledAgentExecutor):
+    """Pre-scan executor that never fails the run.
+
+    The pre-scan is only advisory: if the agent call fails, an empty approved review is
+    sent instead so join_compliance_prescan still releases the Clarity draft.
+    """
+
+    async def _run_agent_and_emit(self, ctx: WorkflowContext[AgentExecutorResponse, AgentRunResponse]) -> None:
+        try:
+            await super()._run_agent_and_emit(ctx)
+        except Exception as e:
+            logger.warning(f"⚠️  Compliance pre-scan failed, continuing without it: {e}")
+            self._cache.clear()
+            review = ComplianceReview(approved=True, issues=[], feedback="", content="")
+            response = AgentRunResponse(messages=[ChatMessage(Role.ASSISTANT, text=review.model_dump_json())])
+            await ctx.send_message(AgentExecutorResponse(self.id, response))
+
+
+@executor(id="join_compliance_prescan")
+async def join_compliance_prescan(
     response: AgentExecutorResponse,
-    ctx: WorkflowContext[None, str]
+    ctx: WorkflowContext[AgentExecutorRequest]
 ) -> None:
-    """Request missing information from user."""
-    profile = NeedProfile.model_validate_json(response.agent_run_response.text)
+    """Barrier: forward the Clarity draft to Compliance once the pre-scan has completed."""
+    async with ctx.shared_state.hold():
+        if response.executor_id == "compliance_prescan":
+            await ctx.shared_state.set_within_hold(PRESCAN_RESULT_KEY, response.agent_run_response.text)
+            await ctx.shared_state.set_within_hold(PRESCAN_PENDING_KEY, False)
+            if not await ctx.shared_state.has_within_hold(PENDING_DRAFT_KEY):
+                return
+            draft = await ctx.shared_state.get_within_hold(PENDING_DRAFT_KEY)
+            await ctx.shared_state.delete_within_hold(PENDING_DRAFT_KEY)
+        else:
+            draft = response
+            pending = (
+                await ctx.shared_state.has_within_hold(PRESCAN_PENDING_KEY)
+                and await ctx.shared_state.get_within_hold(PRESCAN_PENDING_KEY)
+            )
+            if pending:
+                # Pre-scan todavía en curso: guardamos el borrador hasta que llegue
+                await ctx.shared_state.set_within_hold(PENDING_DRAFT_KEY, draft)
+                return
+        
+        # Los hallazgos del pre-scan solo acompañan al primer borrador; las revisiones ya no los llevan
+        prescan_text = None
+        if await ctx.shared_state.has_within_hold(PRESCAN_RESULT_KEY):
+            prescan_text = await ctx.shared_state.get_within_hold(PRESCAN_RESULT_KEY)
+            await ctx.shared_state.delete_within_hold(PRESCAN_RESULT_KEY)
     
-    missing_items = "\n".join(f"- {item}" for item in profile.missing_info)
-    output = (
-        f"📋 **Necesitamos más información para ayudarte mejor:**\n\n"
-        f"{missing_items}\n\n"
-        f"Por favor, proporciona estos datos para poder ofrecerte las mejores opciones del Banco Sabadell."
-    )
-    await ctx.yield_output(output)
+    messages = list(draft.full_conversation or draft.agent_run_response.messages)
+    if prescan_text:
+        try:
+            prescan = _fast_parse(ComplianceReview, prescan_text)
+            if prescan.issues:
+                messages.append(ChatMessage(
+                    Role.USER,
+                    text=f"{PRESCAN_NOTE_HEADER}\n" + "\n".join(f"- {issue}" for issue in prescan.issues)
+                ))
+        except Exception as e:
+            logger.warning(f"⚠️  Could not parse compliance pre-scan: {e}")
+    
+    await ctx.send_message(AgentExecutorRequest(messages=messages, should_respond=True))
 
 
-@executor(id="publish_final_response")
-async def publish_final_response(
-    response: AgentExecutorResponse,
-    ctx: WorkflowContext[None, str]
-) -> None:
-    """Publish the final approved response."""
+@dataclass
+class SpeculativeRun:
+    """In-flight Publisher run plus the queue its streamed updates land in."""
+    task: asyncio.Task[AgentRunResponse]
+    source_id: str  # Executor id the run's events are reported under
+    updates: asyncio.Queue[AgentRunResponseUpdate | None] = field(default_factory=asyncio.Queue)
+
+
+def _retrieve_task_exception(task: asyncio.Task[Any]) -> None:
+    """Done-callback: mark the exception as retrieved so discarded runs don't log 'never retrieved'."""
+    if not task.cancelled():
+        task.exception()
+
+
+def start_publisher_run(agent: AgentProtocol, content: str, source_id: str) -> SpeculativeRun:
+    """Start a streamed Publisher run on content in the background."""
+    updates: asyncio.Queue[AgentRunResponseUpdate | None] = asyncio.Queue()
+    task = asyncio.create_task(_stream_agent(
+        agent,
+        [ChatMessage(Role.USER, text=content)],
+        updates,
+        output_format_type=FinalResponse,
+    ))
+    task.add_done_callback(_retrieve_task_exception)
+    return SpeculativeRun(task, source_id, updates)
+
+
+class SpeculativePublisher(Executor):
+    """Start the Publisher on each Clarity draft while Compliance is still reviewing it."""
+
+    def __init__(self, agent: AgentProtocol, id: str = "speculative_publish"):
+        super().__init__(id=id)
+        self._agent = agent
+
+    @handler
+    async def start(self, response: AgentExecutorResponse, ctx: WorkflowContext) -> None:
+        """Launch the Publisher call in the background and store its task in shared state."""
+        try:
+            draft = _get_parsed(response, ClarityExplanation)
+            content = draft.full_content
+        except Exception:
+            content = response.agent_run_response.text
+        
+        await cancel_speculative_publish(ctx)
+        await ctx.set_shared_state(SPECULATIVE_PUBLISH_KEY, start_publisher_run(self._agent, content, self.id))
+
+
+async def cancel_speculative_publish(ctx: WorkflowContext[Any, Any]) -> None:
+    """Cancel the in-flight speculative Publisher task, if any."""
+    if not await ctx.shared_state.has(SPECULATIVE_PUBLISH_KEY):
+        return
+    run = await ctx.get_shared_state(SPECULATIVE_PUBLISH_KEY)
+    await ctx.shared_state.delete(SPECULATIVE_PUBLISH_KEY)
+    if not run.task.done():
+        run.task.cancel()
+
+
+class FinalPublisher(Executor):
+    """Publish the approved response, reusing the speculative Publisher run when there is one."""
+
+    def __init__(self, agent: AgentProtocol, id: str = "publish_final_response"):
+        super().__init__(id=id)
+        self._agent = agent
+
+    @handler
+    async def publish(self, response: AgentExecutorResponse, ctx: WorkflowContext[None, str]) -> None:
+        """Wait for (or start) the Publisher run and yield its formatted content."""
+        if await ctx.shared_state.has(SPECULATIVE_PUBLISH_KEY):
+            run = await ctx.get_shared_state(SPECULATIVE_PUBLISH_KEY)
+            await ctx.shared_state.delete(SPECULATIVE_PUBLISH_KEY)
+        else:
+            # Sin publicación especulativa: ejecutamos el Publisher ahora sobre el contenido aprobado
+            run = start_publisher_run(self._agent, _get_review(response).content, self.id)
+        
+        if ctx.is_streaming():
+            # Tokens ya generados salen de golpe; el resto según llegan
+            while (update := await run.updates.get()) is not None:
+                await ctx.add_event(AgentRunUpdateEvent(run.source_id, update))
+            publisher_response = await run.task
+        else:
+            publisher_response = await run.task
+            await ctx.add_event(AgentRunEvent(run.source_id, publisher_response))
+        
+        try:
+            final = publisher_response.value
+            if not isinstance(final, FinalResponse):
+                final = _fast_parse(FinalResponse, publisher_response.text)
+            await ctx.yield_output(f"✅ **RESPUESTA FINAL:**\n\n{final.content}")
+        except Exception as e:
+            # Si falla el parseo JSON, mostrar el texto tal cual
+            print(f"⚠️  Warning: Could not parse Publisher output as JSON: {e}")
+            print(f"Raw output: {publisher_response.text[:500]}")
+            await ctx.yield_output(f"✅ **RESPUESTA FINAL:**\n\n{publisher_response.text}")
+
+
+# ============================================================================
+# COPILOT STUDIO HTTP CONNECTION POOL
+# ============================================================================
+
+# Connector compartido: el SDK abre una ClientSession por petición, pero al
+# reutilizar el connector se mantienen las conexiones keep-alive (sin TLS por llamada)
+_copilot_connector: aiohttp.TCPConnector | None = None
+
+
+def _copilot_session_settings() -> dict[str, Any]:
+    """ClientSession kwargs that plug the shared keep-alive connector into the Copilot client."""
+    global _copilot_connector
+    if _copilot_connector is None or _copilot_connector.closed:
+        # Must be created inside the running event loop (DevUI server loop)
+        _copilot_connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, keepalive_timeout=60)
+    return {"connector": _copilot_connector, "connector_owner": False}
+
+
+class PooledCopilotStudioAgent(CopilotStudioAgent):
+    """CopilotStudioAgent whose HTTP calls share a process-wide aiohttp connection pool."""
+
+    def _use_shared_connector(self) -> None:
+        self.client.settings.client_session_settings.update(_copilot_session_settings())
+
+    async def run(self, *args: Any, **kwargs: Any) -> AgentRunResponse:
+        self._use_shared_connector()
+        return await super().run(*args, **kwargs)
+
+    async def run_stream(self, *args: Any, **kwargs: Any) -> AsyncIterable[AgentRunResponseUpdate]:
+        self._use_shared_connector()
+        async for update in super().run_stream(*args, **kwargs):
+            yield update
+
+
+# ============================================================================
+# COPILOT STUDIO TOKEN CACHE
+# ============================================================================
+
+_copilot_token_cache: PersistedTokenCache | None = None
+
+
+def get_copilot_token_cache() -> PersistedTokenCache:
+    """Process-wide token cache for Copilot Studio, persisted in the user's home directory."""
+    global _copilot_token_cache
+    if _copilot_token_cache is None:
+        cache_location = os.path.join(os.path.expanduser("~"), ".copilot_token_cache.bin")
+        _copilot_token_cache = PersistedTokenCache(FilePersistence(cache_location))
+    return _copilot_token_cache
+
+
+# ============================================================================
+# AZURE CREDENTIAL (shared + warmed at startup)
+# ============================================================================
+
+# Scope used by AzureAIAgentClient (Azure AI Foundry Agents)
+AZURE_AI_SCOPE = "https://ai.azure.com/.default"
+
+# En local (MAF_LOCAL_DEV=true) saltamos Managed Identity y su sondeo de IMDS
+_credential = DefaultAzureCredential(
+    exclude_managed_identity_credential=os.getenv("MAF_LOCAL_DEV", "false").lower() == "true"
+)
+
+
+def warmup_credential() -> None:
+    """Resolve the credential chain and cache a token before the first workflow run."""
+    start = time.perf_counter()
     try:
-        final = FinalResponse.model_validate_json(response.agent_run_response.text)
-        await ctx.yield_output(f"✅ **RESPUESTA FINAL:**\n\n{final.content}")
+        _credential.get_token(AZURE_AI_SCOPE)
+        logger.info(f"🔑 Credencial Azure preparada en {time.perf_counter() - start:.2f}s")
     except Exception as e:
-        # Si falla el parseo JSON, mostrar el texto tal cual
-        print(f"⚠️  Warning: Could not parse Publisher output as JSON: {e}")
-        print(f"Raw output: {response.agent_run_response.text[:500]}")
-        await ctx.yield_output(f"✅ **RESPUESTA FINAL:**\n\n{response.agent_run_response.text}")
+        # No es fatal: el primer run volverá a intentarlo
+        logger.warning(f"⚠️  Could not warm up Azure credential: {e}")
+
+
+# ============================================================================
+# AGENT INSTRUCTIONS
+# ============================================================================
+
+# Sabadell Need Profiler
+_INSTR_NEED_PROFILER: Final[str] = (
+    "Eres un analista de necesidades financieras. Tu trabajo es interpretar la pregunta del cliente "
+    "y estructurarla para facilitar la búsqueda de productos.\n\n"
+    "Debes identificar:\n"
+    "- product_type: tipo de producto (hipoteca, cuenta, tarjeta, préstamo, ahorro, inversión)\n"
+    "- customer_type: perfil del cliente (nuevo, existente, autónomo, empresa, joven, senior)\n"
+    "- key_constraints: características específicas que busca (tipo fijo, sin comisiones, online, vinculación)\n"
+    "- missing_info: SOLO información ABSOLUTAMENTE CRÍTICA sin la cual NO SE PUEDE dar NINGUNA respuesta útil\n"
+    "- structured_query: una pregunta bien formulada para el experto de productos\n\n"
+    "IMPORTANTE sobre missing_info:\n"
+    "- Deja este campo VACÍO [] si hay suficiente información para dar una respuesta general sobre productos\n"
+    "- Solo marca missing_info si el cliente no ha dicho QUÉ producto quiere (ej: solo dice 'ayúdame con finanzas')\n"
+    "- Detalles como edad exacta, importe exacto, residencia NO son críticos - el experto puede dar info general\n\n"
+    "EJEMPLO 1 (información SUFICIENTE):\n"
+    "Input: 'Quiero hipoteca tipo fijo, gano 3000€, soy nuevo cliente'\n"
+    "Output: {\n"
+    "  'product_type': 'hipoteca',\n"
+    "  'customer_type': 'nuevo',\n"
+    "  'key_constraints': ['tipo fijo', 'ingresos 3000€'],\n"
+    "  'missing_info': [],\n"
+    "  'structured_query': 'Cliente nuevo con ingresos de 3.000€/mes busca hipoteca a tipo fijo. "
+    "Explica las opciones de hipotecas fijas del Banco Sabadell y sus condiciones generales.'\n"
+    "}\n\n"
+    "EJEMPLO 2 (información INSUFICIENTE):\n"
+    "Input: 'Quiero información del banco'\n"
+    "Output: {\n"
+    "  'product_type': 'sin especificar',\n"
+    "  'customer_type': 'sin especificar',\n"
+    "  'key_constraints': [],\n"
+    "  'missing_info': ['qué tipo de producto o servicio necesitas'],\n"
+    "  'structured_query': ''\n"
+    "}\n\n"
+    "Devuelve siempre JSON con estos campos."
+)
+
+# Clarity Writer
+_INSTR_CLARITY_WRITER: Final[str] = (
+    "Eres un comunicador financiero experto en lenguaje claro. Tu trabajo es reescribir "
+    "información de productos bancarios en un formato fácil de entender para clientes finales.\n\n"
+    "REGLAS ESTRICTAS:\n"
+    "1. NO des recomendaciones personalizadas ('deberías contratar...', 'te conviene...')\n"
+    "2. Solo presenta información objetiva de productos\n"
+    "3. Usa lenguaje sencillo, sin jerga técnica\n"
+    "4. Explica términos complejos (TIN, TAE, vinculación, etc.)\n"
+    "5. Estructura la información claramente\n"
+    "6. Incluye siempre el aviso: 'Esta información no constituye asesoramiento financiero personalizado'\n"
+    "7. Remite siempre a bancsabadell.com para consultar las condiciones actualizadas\n\n"
+    "Devuelve JSON con:\n"
+    "- summary: explicación general clara (2-3 párrafos)\n"
+    "- pros_cons: lista de 3-5 puntos clave (ventajas y consideraciones)\n"
+    "- cta: llamada a la acción específica (enlace web, teléfono, oficina)\n"
+    "- full_content: el contenido completo formateado y listo para mostrar\n\n"
+    "EJEMPLO de full_content:\n"
+    "**Hipotecas a Tipo Fijo del Banco Sabadell**\n\n"
+    "[Explicación clara]\n\n"
+    "**Puntos clave:**\n- [pros/cons]\n\n"
+    "**Próximos pasos:**\n[CTA específico]\n\n"
+    "_Esta información no constituye asesoramiento financiero personalizado. "
+    "Consulta las condiciones actualizadas en bancsabadell.com._"
+)
+
+# Compliance & Risk Checker
+_INSTR_COMPLIANCE_CHECKER: Final[str] = (
+    "Eres un auditor de cumplimiento normativo financiero. Tu trabajo es verificar que "
+    "las comunicaciones al cliente cumplan con regulaciones y buenas prácticas.\n\n"
+    "VERIFICACIONES OBLIGATORIAS:\n"
+    "1. ✓ NO hay recomendaciones personalizadas sin perfil completo\n"
+    "2. ✓ SÍ hay disclaimer: 'Esta información no constituye asesoramiento financiero personalizado'\n"
+    "3. ✓ SÍ hay referencia a consultar web oficial para condiciones actualizadas\n"
+    "4. ✓ NO se inventan condiciones no mencionadas en la información original\n"
+    "5. ✓ El lenguaje es informativo, no prescriptivo\n"
+    "6. ✓ Se mencionan requisitos y condiciones importantes\n\n"
+    "Devuelve JSON con:\n"
+    "- approved: true si cumple TODAS las verificaciones\n"
+    "- issues: lista de problemas específicos detectados (vacía si approved=true)\n"
+    "- feedback: instrucciones claras de cómo corregir cada issue\n"
+    "- content: el contenido revisado (para referencia)\n\n"
+    "Sé estricto pero constructivo. El objetivo es proteger al cliente y al banco."
+)
+
+# Compliance Pre-Scan
+_INSTR_COMPLIANCE_PRESCAN: Final[str] = (
+    "Eres un auditor de cumplimiento normativo financiero. Recibes la información de productos "
+    "ORIGINAL (antes de reescribirla para el cliente) y debes anticipar riesgos de cumplimiento.\n\n"
+    "Detecta:\n"
+    "- Condiciones, requisitos o comisiones que deberán mencionarse obligatoriamente\n"
+    "- Afirmaciones que podrían interpretarse como recomendación personalizada\n"
+    "- Datos que no deben presentarse como garantizados (tipos, bonificaciones, plazos)\n\n"
+    "Devuelve JSON con:\n"
+    "- approved: true si no detectas riesgos\n"
+    "- issues: lista de puntos que el revisor final debe vigilar\n"
+    "- feedback: cómo tratarlos en el texto para el cliente\n"
+    "- content: la información original (para referencia)"
+)
+
+# Final Publisher
+_INSTR_PUBLISHER: Final[str] = (
+    "Eres el publicador final. Tu trabajo es dar el toque profesional definitivo al contenido aprobado "
+    "y presentarlo de forma clara y atractiva para el cliente.\n\n"
+    "TAREAS:\n"
+    "1. Estructurar en secciones claras con títulos markdown (##, ###)\n"
+    "2. Añadir emojis apropiados para mejorar legibilidad (🏠 💰 📊 ✓ ⚠️ 📞 🌐)\n"
+    "3. Asegurar formato markdown consistente y profesional\n"
+    "4. Incluir una sección introductoria amigable\n"
+    "5. Añadir al final el disclaimer estándar del banco:\n\n"
+    "---\n\n"
+    "**ℹ️ Información importante:**\n"
+    "- Esta información no constituye asesoramiento financiero personalizado\n"
+    "- Las condiciones pueden variar según el perfil del cliente\n"
+    "- Para información actualizada, consulta siempre bancsabadell.com\n"
+    "- Banco Sabadell, S.A. - Inscrito en el Registro Mercantil de Barcelona\n\n"
+    "6. Verificar que el CTA (llamada a la acción) es claro y accionable\n\n"
+    "IMPORTANTE: Devuelve el resultado en formato JSON con el campo 'content' "
+    "que contenga el texto completo formateado en markdown."
+)
 
 
 # ============================================================================
 # WORKFLOW CREATION
 # ============================================================================
 
-def create_sabadell_advisor_workflow():
-    """Create the complete Sabadell advisor workflow with all agents."""
-    
-    # Create Azure AI Agent client for Azure agents
-    agent_client = AzureAIAgentClient(
-        async_credential=DefaultAzureCredential()
+@functools.lru_cache(maxsize=1)
+def get_agent_client() -> AzureAIAgentClient:
+    """Process-wide Azure AI Agent client for Azure agents.
+
+    SDK retries are disabled (retry_total=0): transient errors are retried by _run_agent /
+    _stream_agent, which release the LLM slot while backing off.
+    """
+    project_client = AIProjectClient(
+        endpoint=os.environ["AZURE_AI_PROJECT_ENDPOINT"],
+        credential=_credential,
+        retry_total=0,
+    )
+    return AzureAIAgentClient(
+        project_client=project_client,
+        async_credential=_credential
     )
+
+
+def create_sabadell_advisor_workflow():
+    """Create the complete Sabadell advisor workflow with all agents.
+
+    Every call builds a new Workflow (a Workflow instance cannot run concurrently);
+    the underlying Azure AI Agent client is shared process-wide.
+    """
+    agent_client = get_agent_client()
     
     # ========================================================================
     # AGENT 1: NEED PROFILER (Azure Agent)
     # ========================================================================
-    need_profiler = AgentExecutor(
+    need_profiler = CachedAgentExecutor(
         agent_client.create_agent(
-            instructions=(
-                "Eres un analista de necesidades financieras. Tu trabajo es interpretar la pregunta del cliente "
-                "y estructurarla para facilitar la búsqueda de productos.\n\n"
-                "Debes identificar:\n"
-                "- product_type: tipo de producto (hipoteca, cuenta, tarjeta, préstamo, ahorro, inversión)\n"
-                "- customer_type: perfil del cliente (nuevo, existente, autónomo, empresa, joven, senior)\n"
-                "- key_constraints: características específicas que busca (tipo fijo, sin comisiones, online, vinculación)\n"
-                "- missing_info: SOLO información ABSOLUTAMENTE CRÍTICA sin la cual NO SE PUEDE dar NINGUNA respuesta útil\n"
-                "- structured_query: una pregunta bien formulada para el experto de productos\n\n"
-                "IMPORTANTE sobre missing_info:\n"
-                "- Deja este campo VACÍO [] si hay suficiente información para dar una respuesta general sobre productos\n"
-                "- Solo marca missing_info si el cliente no ha dicho QUÉ producto quiere (ej: solo dice 'ayúdame con finanzas')\n"
-                "- Detalles como edad exacta, importe exacto, residencia NO son críticos - el experto puede dar info general\n\n"
-                "EJEMPLO 1 (información SUFICIENTE):\n"
-                "Input: 'Quiero hipoteca tipo fijo, gano 3000€, soy nuevo cliente'\n"
-                "Output: {\n"
-                "  'product_type': 'hipoteca',\n"
-                "  'customer_type': 'nuevo',\n"
-                "  'key_constraints': ['tipo fijo', 'ingresos 3000€'],\n"
-                "  'missing_info': [],\n"
-                "  'structured_query': 'Cliente nuevo con ingresos de 3.000€/mes busca hipoteca a tipo fijo. "
-                "Explica las opciones de hipotecas fijas del Banco Sabadell y sus condiciones generales.'\n"
-                "}\n\n"
-                "EJEMPLO 2 (información INSUFICIENTE):\n"
-                "Input: 'Quiero información del banco'\n"
-                "Output: {\n"
-                "  'product_type': 'sin especificar',\n"
-                "  'customer_type': 'sin especificar',\n"
-                "  'key_constraints': [],\n"
-                "  'missing_info': ['qué tipo de producto o servicio necesitas'],\n"
-                "  'structured_query': ''\n"
-                "}\n\n"
-                "Devuelve siempre JSON con estos campos."
-            ),
+            instructions=_INSTR_NEED_PROFILER,
             name="Sabadell Need Profiler",
             response_format=NeedProfile,
         ),
+        cache=_need_profile_cache,
         id="need_profiler",
+        post_transform=route_need_profile,
+        post_output_types=[AgentExecutorRequest],
+        post_workflow_output_types=[str],
     )
     
     # ========================================================================
     # AGENT 2: SABADELL PRODUCT EXPERT (Copilot Studio Agent)
     # ========================================================================
-    # Configure token cache for persistent authentication
-    from msal_extensions import (
-        FilePersistence,
-        PersistedTokenCache,
-    )
-    
-    # Create a persistent token cache in the workspace
-    cache_location = os.path.join(os.path.expanduser("~"), ".copilot_token_cache.bin")
-    persistence = FilePersistence(cache_location)
-    token_cache = PersistedTokenCache(persistence)
-    
-    sabadell_expert = AgentExecutor(
-        CopilotStudioAgent(
-            token_cache=token_cache,  # Use persistent token cache
+    sabadell_expert = ThrottledAgentExecutor(
+        PooledCopilotStudioAgent(
+            token_cache=get_copilot_token_cache(),  # Persistent token cache shared across workflow builds
         ),
         id="sabadell_copilot_expert",
+        post_transform=to_clarity_request,
+        post_output_types=[AgentExecutorRequest],
     )
     
     # ========================================================================
     # AGENT 3: CLARITY WRITER (Azure Agent)
     # ========================================================================
-    clarity_writer = AgentExecutor(
+    clarity_writer = ThrottledAgentExecutor(
         agent_client.create_agent(
-            instructions=(
-                "Eres un comunicador financiero experto en lenguaje claro. Tu trabajo es reescribir "
-                "información de productos bancarios en un formato fácil de entender para clientes finales.\n\n"
-                "REGLAS ESTRICTAS:\n"
-                "1. NO des recomendaciones personalizadas ('deberías contratar...', 'te conviene...')\n"
-                "2. Solo presenta información objetiva de productos\n"
-                "3. Usa lenguaje sencillo, sin jerga técnica\n"
-                "4. Explica términos complejos (TIN, TAE, vinculación, etc.)\n"
-                "5. Estructura la información claramente\n\n"
-                "Devuelve JSON con:\n"
-                "- summary: explicación general clara (2-3 párrafos)\n"
-                "- pros_cons: lista de 3-5 puntos clave (ventajas y consideraciones)\n"
-                "- cta: llamada a la acción específica (enlace web, teléfono, oficina)\n"
-                "- full_content: el contenido completo formateado y listo para mostrar\n\n"
-                "EJEMPLO de full_content:\n"
-                "**Hipotecas a Tipo Fijo del Banco Sabadell**\n\n"
-                "[Explicación clara]\n\n"
-                "**Puntos clave:**\n- [pros/cons]\n\n"
-                "**Próximos pasos:**\n[CTA específico]"
-            ),
+            instructions=_INSTR_CLARITY_WRITER,
             name="Clarity Writer",
             response_format=ClarityExplanation,
         ),
         id="clarity_writer",
+        thread_state_key=CLARITY_THREAD_KEY,
     )
     
     # ========================================================================
     # AGENT 4: COMPLIANCE & RISK CHECKER (Azure Agent)
     # ========================================================================
-    compliance_checker = AgentExecutor(
+    compliance_checker = RuleGatedComplianceExecutor(
         agent_client.create_agent(
-            instructions=(
-                "Eres un auditor de cumplimiento normativo financiero. Tu trabajo es verificar que "
-                "las comunicaciones al cliente cumplan con regulaciones y buenas prácticas.\n\n"
-                "VERIFICACIONES OBLIGATORIAS:\n"
-                "1. ✓ NO hay recomendaciones personalizadas sin perfil completo\n"
-                "2. ✓ SÍ hay disclaimer: 'Esta información no constituye asesoramiento financiero personalizado'\n"
-                "3. ✓ SÍ hay referencia a consultar web oficial para condiciones actualizadas\n"
-                "4. ✓ NO se inventan condiciones no mencionadas en la información original\n"
-                "5. ✓ El lenguaje es informativo, no prescriptivo\n"
-                "6. ✓ Se mencionan requisitos y condiciones importantes\n\n"
-                "Devuelve JSON con:\n"
-                "- approved: true si cumple TODAS las verificaciones\n"
-                "- issues: lista de problemas específicos detectados (vacía si approved=true)\n"
-                "- feedback: instrucciones claras de cómo corregir cada issue\n"
-                "- content: el contenido revisado (para referencia)\n\n"
-                "Sé estricto pero constructivo. El objetivo es proteger al cliente y al banco."
-            ),
+            instructions=_INSTR_COMPLIANCE_CHECKER,
             name="Compliance & Risk Checker",
             response_format=ComplianceReview,
         ),
+        cache=_compliance_cache,
         id="compliance_checker",
+        post_transform=route_compliance_review,
+        post_output_types=[AgentExecutorRequest],
+    )
+    
+    # Pre-scan especulativo sobre la información original, en paralelo al Clarity Writer
+    compliance_prescan = CompliancePrescanExecutor(
+        agent_client.create_agent(
+            instructions=_INSTR_COMPLIANCE_PRESCAN,
+            name="Compliance Pre-Scan",
+            response_format=ComplianceReview,
+        ),
+        id="compliance_prescan",
     )
     
     # ========================================================================
     # AGENT 5: PUBLISHER (Azure Agent)
     # ========================================================================
-    publisher = AgentExecutor(
-        agent_client.create_agent(
-            instructions=(
-                "Eres el publicador final. Tu trabajo es dar el toque profesional definitivo al contenido aprobado "
-                "y presentarlo de forma clara y atractiva para el cliente.\n\n"
-                "TAREAS:\n"
-                "1. Estructurar en secciones claras con títulos markdown (##, ###)\n"
-                "2. Añadir emojis apropiados para mejorar legibilidad (🏠 💰 📊 ✓ ⚠️ 📞 🌐)\n"
-                "3. Asegurar formato markdown consistente y profesional\n"
-                "4. Incluir una sección introductoria amigable\n"
-                "5. Añadir al final el disclaimer estándar del banco:\n\n"
-                "---\n\n"
-                "**ℹ️ Información importante:**\n"
-                "- Esta información no constituye asesoramiento financiero personalizado\n"
-                "- Las condiciones pueden variar según el perfil del cliente\n"
-                "- Para información actualizada, consulta siempre bancsabadell.com\n"
-                "- Banco Sabadell, S.A. - Inscrito en el Registro Mercantil de Barcelona\n\n"
-                "6. Verificar que el CTA (llamada a la acción) es claro y accionable\n\n"
-                "IMPORTANTE: Devuelve el resultado en formato JSON con el campo 'content' "
-                "que contenga el texto completo formateado en markdown."
-            ),
-            name="Final Publisher",
-            response_format=FinalResponse,
-        ),
-        id="publisher",
+    # Se ejecuta especulativamente sobre el borrador mientras Compliance lo revisa;
+    # si no hay ejecución especulativa, publish_final_response lo lanza directamente
+    publisher_agent = agent_client.create_agent(
+        instructions=_INSTR_PUBLISHER,
+        name="Final Publisher",
+        response_format=FinalResponse,
     )
+    publisher = SpeculativePublisher(publisher_agent, id="speculative_publish")
+    publish_final_response = FinalPublisher(publisher_agent, id="publish_final_response")
     
     # ========================================================================
     # BUILD WORKFLOW WITH CONDITIONAL ROUTING
@@ -384,28 +1145,25 @@ def create_sabadell_advisor_workflow():
         # Start: Customer question → Need Profiler
         .set_start_executor(need_profiler)
         
-        # Path 1: Missing info → Request more info (terminal)
-        .add_edge(need_profiler, request_more_info, condition=missing_info_condition)
+        # Need Profiler (+ routing): complete info → Copilot Expert | missing info → output
+        .add_edge(need_profiler, sabadell_expert)
         
-        # Path 2: Complete info → Continue workflow
-        # Need Profiler → Bridge → Copilot Expert (solo si NO falta info)
-        .add_edge(need_profiler, to_copilot_query, condition=has_complete_info_condition)
-        .add_edge(to_copilot_query, sabadell_expert)
+        # Copilot Expert (+ to_clarity_request) → [Clarity Writer ∥ Compliance Pre-Scan]
+        .add_fan_out_edges(sabadell_expert, [clarity_writer, compliance_prescan])
         
-        # Copilot Expert → Bridge → Clarity Writer
-        .add_edge(sabadell_expert, to_clarity_request)
-        .add_edge(to_clarity_request, clarity_writer)
+        # Clarity Writer + Pre-Scan → Barrier → Compliance Checker
+        .add_edge(clarity_writer, join_compliance_prescan)
+        .add_edge(compliance_prescan, join_compliance_prescan)
+        .add_edge(join_compliance_prescan, compliance_checker)
         
-        # Clarity Writer → Compliance Checker
-        .add_edge(clarity_writer, compliance_checker)
+        # Clarity Writer → Publisher (especulativo, en paralelo con Compliance)
+        .add_edge(clarity_writer, publisher)
         
-        # Compliance approved → Publisher → Output
-        .add_edge(compliance_checker, publisher, condition=approved_condition)
-        .add_edge(publisher, publish_final_response)
+        # Compliance (+ routing): approved → Output (espera al Publisher especulativo)
+        .add_edge(compliance_checker, publish_final_response)
         
-        # Compliance rejected → Bridge → Clarity Writer (LOOP)
-        .add_edge(compliance_checker, to_clarity_revision, condition=rejected_condition)
-        .add_edge(to_clarity_revision, clarity_writer)
+        # Compliance (+ routing): rejected → Clarity Writer (LOOP)
+        .add_edge(compliance_checker, clarity_writer)
         
         .build()
     )
@@ -432,6 +1190,8 @@ def main():
     print("╚" + "═" * 78 + "╝")
     print("\n")
     
+    warmup_credential()
+    
     logger.info("🚀 Creando Sabadell Product Advisor Workflow...")
     workflow = create_sabadell_advisor_workflow()
     